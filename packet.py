@@ -2,11 +2,18 @@ import logging
 from typing import *
 import abc
 import struct
-import collections
+import sys
 import transport
 
 
+# Whether received values should be checked with checkValue as well. This costs a call per field,
+# so it's meant for debugging. Integer bounds are enforced regardless
+DEBUG = False
+
+
 class Serializable(object, metaclass=abc.ABCMeta):
+    __slots__ = ()
+
     @abc.abstractmethod
     def write(self, tp):
         """
@@ -23,53 +30,98 @@ class Serializable(object, metaclass=abc.ABCMeta):
         """
         pass
 
-
-class Field(Serializable):
-    def __init__(self, definition):
-        """
-        :type definition: FieldDef
+    @abc.abstractmethod
+    def packInto(self, buf):
         """
-        self.definition = definition
-        self._value = None
-        self.value = self.definition.default
+        Serialize into buf, instead of writing to a transport directly
 
-    @property
-    def value(self):
-        return self._value
-
-    @value.setter
-    def value(self, val):
-        self._value = val
+        :type buf: bytearray
+        :rtype: None
+        """
+        pass
 
-    def write(self, tp):
-        self.definition.write(self.value, tp)
+    @abc.abstractmethod
+    def readFrom(self, mv, offset):
+        """
+        Deserialize from an already received buffer, starting at offset
 
-    def read(self, tp):
-        self.value = self.definition.read(tp)
+        :type mv: memoryview
+        :type offset: int
+        :return: The offset right after the consumed data
+        :rtype: int
+        """
+        pass
 
 
 class FieldDef(object, metaclass=abc.ABCMeta):
+    # The exact encoded size, for fields that have one. None means the field is variable-length
+    size = None
+    # Whether the encoded default should be kept around, so that packing the default is just a copy.
+    # Subclasses that enable this should check _defaultBytes in packInto, and call _refreshDefault
+    # whenever their encoding changes
+    _preEncodeDefault = False
+
     def __init__(self, name):
         self.name = name
         self.default = None
+        self._defaultBytes = None
 
     # Such 'transparent configurators' should be implemented for settings, which the user is allowed not to set
     # (Hopefully that's adequate English...)
     def setDefault(self, default):
         self.default = default
+        self._refreshDefault()
         return self
 
-    @abc.abstractmethod
+    def _refreshDefault(self):
+        self._defaultBytes = None
+        if self._preEncodeDefault and self.default is not None:
+            buf = bytearray()
+            self.packInto(self.default, buf)
+            self._defaultBytes = bytes(buf)
+
     def write(self, value, tp):
+        # Serialized as a whole, so that multi-part fields still only take one send
+        buf = bytearray()
+        self.packInto(value, buf)
+        tp.write(buf)
+
+    @abc.abstractmethod
+    def packInto(self, value, buf):
         pass
 
     @abc.abstractmethod
     def read(self, tp):
         pass
 
+    @abc.abstractmethod
+    def readFrom(self, mv, offset):
+        """
+        :type mv: memoryview
+        :type offset: int
+        :return: The value and the offset right after it
+        :rtype: tuple
+        """
+        pass
+
     def checkValue(self, value):
         return True
 
+    def _structPart(self):
+        """
+        How this field can be encoded as part of a bigger struct, if at all.
+        Packets use this to handle their leading fields with a single struct.Struct
+
+        :return: The byte order character (or None if irrelevant), the format codes and the number of items they
+                 produce (None for a single non-tuple value), or None if the field can't be encoded with struct
+        :rtype: tuple | None
+        """
+        return None
+
+    def validate(self, value):
+        if not self.checkValue(value):
+            raise ValueError(f"Bad value for {self.name}: {value!r}")
+
 
 class FixedLengthFD(FieldDef):
     valueType = bytes
@@ -78,14 +130,14 @@ class FixedLengthFD(FieldDef):
         super().__init__(name)
         assert length >= 0
         self.length = length
+        self.size = length
 
-    def write(self, value, tp):
+    def packInto(self, value, buf):
         """
         :type value: bytes
-        :type tp: transport.Transport
+        :type buf: bytearray
         """
-        assert self.checkValue(value)
-        tp.write(value)
+        buf += value
 
     def read(self, tp):
         """
@@ -93,12 +145,23 @@ class FixedLengthFD(FieldDef):
         :rtype: bytes
         """
         value = tp.read(self.length)
-        assert self.checkValue(value)
+        if DEBUG:
+            self.validate(value)
         return value
 
+    def readFrom(self, mv, offset):
+        end = offset + self.length
+        value = bytes(mv[offset:end])
+        if DEBUG:
+            self.validate(value)
+        return value, end
+
     def checkValue(self, value):
         return isinstance(value, (bytes, bytearray)) and len(value) == self.length
 
+    def _structPart(self):
+        return None, f"{self.length}s", None
+
 
 class VarLengthFD(FieldDef):
     def __init__(self, name, lengthFieldSize):
@@ -117,14 +180,13 @@ class VarLengthFD(FieldDef):
         self.lengthFD.setOrder(order)
         return self
 
-    def write(self, value, tp):
+    def packInto(self, value, buf):
         """
         :type value: bytes
-        :type tp: transport.Transport
+        :type buf: bytearray
         """
-        assert self.checkValue(value)
-        self.lengthFD.write(len(value), tp)
-        tp.write(value)
+        self.lengthFD.packInto(len(value), buf)
+        buf += value
 
     def read(self, tp):
         """
@@ -133,111 +195,222 @@ class VarLengthFD(FieldDef):
         """
         length = self.lengthFD.read(tp)
         value = tp.read(length)
-        assert self.checkValue(value)
+        if DEBUG:
+            self.validate(value)
         return value
 
+    def readFrom(self, mv, offset):
+        length, offset = self.lengthFD.readFrom(mv, offset)
+        end = offset + length
+        value = bytes(mv[offset:end])
+        if DEBUG:
+            self.validate(value)
+        return value, end
+
     def checkValue(self, value):
-        return isinstance(value, (bytes, bytearray))
+        return isinstance(value, (bytes, bytearray)) and self.lengthFD.checkValue(len(value))
 
 
 class IntFD(FieldDef):
+    _preEncodeDefault = True
+    # struct codes for the widths it supports, as (signed, unsigned)
+    _structCodes = {1: "bB", 2: "hH", 4: "iI", 8: "qQ"}
+    _structOrders = {"big": ">", "little": "<"}
+
     def __init__(self, name, length):
         super().__init__(name)
-        self.innerFD = FixedLengthFD(f"{name}_inner", length)
+        self.size = length
         self.min = None
         self.max = None
         self.order = "big"
         self.signed = False
+        self._check = None
+        self._struct = None
+        self._pack = None
+        self._unpack = None
+        self._unpackFrom = None
+        self._updateStruct()
 
     def setMax(self, maximum):
         self.max = maximum
+        self._updateCheck()
         return self
 
     def setMin(self, minimum):
         self.min = minimum
+        self._updateCheck()
         return self
 
+    def _updateCheck(self):
+        # The bounds check is picked once here, so that it's a single call, or nothing at all without bounds
+        low, high = self.min, self.max
+        if low is None and high is None:
+            self._check = None
+        elif high is None:
+            self._check = lambda value: low <= value
+        elif low is None:
+            self._check = lambda value: value < high
+        else:
+            self._check = lambda value: low <= value < high
+
     def setOrder(self, order):
         # "big" or "little"
         self.order = order
+        self._updateStruct()
         return self
 
     def setSigned(self, signed):
         self.signed = signed
+        self._updateStruct()
         return self
 
-    def write(self, value, tp):
+    def _updateStruct(self):
+        # Other widths fall back to int.to_bytes/int.from_bytes
+        codes = self._structCodes.get(self.size)
+        if codes is None:
+            self._struct = None
+            self._pack = self._unpack = self._unpackFrom = None
+        else:
+            self._struct = struct.Struct(self._structOrders[self.order] + codes[0 if self.signed else 1])
+            # Bound once, to save an attribute lookup on every use
+            self._pack = self._struct.pack
+            self._unpack = self._struct.unpack
+            self._unpackFrom = self._struct.unpack_from
+        self._refreshDefault()
+
+    def packInto(self, value, buf):
         """
         :type value: int
-        :type tp: transport.Transport
+        :type buf: bytearray
         """
-        assert self.checkValue(value)
-        self.innerFD.write(value.to_bytes(self.innerFD.length, self.order, signed=self.signed), tp)
+        if value is self.default and self._defaultBytes is not None:
+            buf += self._defaultBytes
+            return
+        if self._pack is not None:
+            buf += self._pack(value)
+        else:
+            buf += value.to_bytes(self.size, self.order, signed=self.signed)
 
     def read(self, tp):
         """
         :type tp: transport.Transport
         :rtype: int
         """
-        value = int.from_bytes(self.innerFD.read(tp), self.order, signed=self.signed)
-        assert self.checkValue(value)
+        data = tp.read(self.size)
+        if self._unpack is not None:
+            value, = self._unpack(data)
+        else:
+            value = int.from_bytes(data, self.order, signed=self.signed)
+        if self._check is not None and not self._check(value):
+            raise self._outOfRange(value)
         return value
 
+    def readFrom(self, mv, offset):
+        if self._unpackFrom is not None:
+            value, = self._unpackFrom(mv, offset)
+        else:
+            value = int.from_bytes(mv[offset:offset + self.size], self.order, signed=self.signed)
+        if self._check is not None and not self._check(value):
+            raise self._outOfRange(value)
+        return value, offset + self.size
+
     def checkValue(self, value):
-        return isinstance(value, int) and (self.min is None or self.min <= value) and (self.max is None or value < self.max)
+        return isinstance(value, int) and (self._check is None or self._check(value))
+
+    def _outOfRange(self, value):
+        return ValueError(f"{self.name} out of range: {value}")
+
+    def _structPart(self):
+        if self._struct is None:
+            return None
+        # Byte order means nothing for a single byte, so it shouldn't stop neighbouring fields from being combined
+        order = None if self.size == 1 else self._struct.format[0]
+        return order, self._struct.format[1:], None
 
 
 class FloatFD(FieldDef):
+    _preEncodeDefault = True
+    _struct = struct.Struct(">f")
+    _pack = _struct.pack
+    _unpack = _struct.unpack
+    _unpackFrom = _struct.unpack_from
+
     def __init__(self, name):
         super().__init__(name)
-        self.innerFD = FixedLengthFD(f"{name}_inner", 4)
+        self.size = 4
 
-    def write(self, value, tp):
+    def packInto(self, value, buf):
         """
         :type value: float
-        :type tp: transport.Transport
+        :type buf: bytearray
         """
-        assert self.checkValue(value)
-        self.innerFD.write(struct.pack(">f", value), tp)
+        if value is self.default and self._defaultBytes is not None:
+            buf += self._defaultBytes
+            return
+        buf += self._pack(value)
 
     def read(self, tp):
         """
         :type tp: transport.Transport
         :rtype: float
         """
-        value, = struct.unpack(">f", self.innerFD.read(tp))
-        assert self.checkValue(value)
+        value, = self._unpack(tp.read(4))
+        if DEBUG:
+            self.validate(value)
         return value
 
+    def readFrom(self, mv, offset):
+        value, = self._unpackFrom(mv, offset)
+        if DEBUG:
+            self.validate(value)
+        return value, offset + 4
+
     def checkValue(self, value):
         return isinstance(value, float)
 
+    def _structPart(self):
+        return ">", "f", None
+
 
 class StructFD(FieldDef):
+    _preEncodeDefault = True
+
     def __init__(self, name, structDef):
         super().__init__(name)
         if isinstance(structDef, str):
             structDef = struct.Struct(structDef)
         self.struct = structDef
-        self.innerFD = FixedLengthFD(f"{name}_inner", self.struct.size)
+        self.size = self.struct.size
+        self._pack = self.struct.pack
+        self._unpack = self.struct.unpack
+        self._unpackFrom = self.struct.unpack_from
 
-    def write(self, value, tp):
+    def packInto(self, value, buf):
         """
         :type value: tuple
-        :type tp: transport.Transport
+        :type buf: bytearray
         """
-        assert self.checkValue(value)
-        self.innerFD.write(self.struct.pack(*value), tp)
+        if value is self.default and self._defaultBytes is not None:
+            buf += self._defaultBytes
+            return
+        buf += self._pack(*value)
 
     def read(self, tp):
         """
         :type tp: transport.Transport
         :rtype: tuple
         """
-        value = self.struct.unpack(self.innerFD.read(tp))
-        assert self.checkValue(value)
+        value = self._unpack(tp.read(self.size))
+        if DEBUG:
+            self.validate(value)
         return value
 
+    def readFrom(self, mv, offset):
+        value = self._unpackFrom(mv, offset)
+        if DEBUG:
+            self.validate(value)
+        return value, offset + self.size
+
     def checkValue(self, value):
         if not isinstance(value, tuple):
             return False
@@ -247,19 +420,26 @@ class StructFD(FieldDef):
             return False
         return True
 
+    def _structPart(self):
+        fmt = self.struct.format
+        # Native alignment would differ once embedded, so only standard sizes can be combined
+        if fmt[:1] not in ("<", ">", "!", "="):
+            return None
+        order = {"!": ">", "=": "<" if sys.byteorder == "little" else ">"}.get(fmt[0], fmt[0])
+        return order, fmt[1:], len(self.struct.unpack(bytes(self.size)))
+
 
 class SerializableFD(FieldDef):
     def __init__(self, name, packetType):
         super().__init__(name)
         self.packetType = packetType
 
-    def write(self, value, tp):
+    def packInto(self, value, buf):
         """
         :type value: Serializable
-        :type tp: transport.Transport
+        :type buf: bytearray
         """
-        assert self.checkValue(value)
-        value.write(tp)
+        value.packInto(buf)
 
     def read(self, tp):
         """
@@ -267,54 +447,60 @@ class SerializableFD(FieldDef):
         :rtype: Serializable
         """
         value = self.packetType().read(tp)
-        assert self.checkValue(value)
+        if DEBUG:
+            self.validate(value)
         return value
 
+    def readFrom(self, mv, offset):
+        value = self.packetType()
+        offset = value.readFrom(mv, offset)
+        if DEBUG:
+            self.validate(value)
+        return value, offset
+
     def checkValue(self, value):
         return isinstance(value, self.packetType)
 
 
-class StringFD(FieldDef):
+class StringFD(VarLengthFD):
     def __init__(self, name, lengthFieldSize):
-        super().__init__(name)
-        self.innerFD = VarLengthFD(f"{name}_inner", lengthFieldSize)
+        super().__init__(name, lengthFieldSize)
         self.encoding = "utf-8"
 
-    def setMinLength(self, minLength):
-        self.innerFD.setMinLength(minLength)
-        return self
-
-    def setMaxLength(self, maxLength):
-        self.innerFD.setMaxLength(maxLength)
-        return self
-
-    def setLengthOrder(self, order):
-        self.innerFD.setLengthOrder(order)
-        return self
-
     def setEncoding(self, encoding):
         self.encoding = encoding
         return self
 
-    def write(self, value, tp):
+    def packInto(self, value, buf):
         """
         :type value: str
-        :type tp: transport.Transport
+        :type buf: bytearray
         """
-        assert self.checkValue(value)
-        self.innerFD.write(value.encode(self.encoding), tp)
+        data = value.encode(self.encoding)
+        self.lengthFD.packInto(len(data), buf)
+        buf += data
 
     def read(self, tp):
         """
         :type tp: transport.Transport
         :rtype: str
         """
-        value = self.innerFD.read(tp).decode(self.encoding)
-        assert self.checkValue(value)
+        length = self.lengthFD.read(tp)
+        value = tp.read(length).decode(self.encoding)
+        if DEBUG:
+            self.validate(value)
         return value
 
+    def readFrom(self, mv, offset):
+        length, offset = self.lengthFD.readFrom(mv, offset)
+        end = offset + length
+        value = str(mv[offset:end], self.encoding)
+        if DEBUG:
+            self.validate(value)
+        return value, end
+
     def checkValue(self, value):
-        return isinstance(value, str)
+        return isinstance(value, str) and self.lengthFD.checkValue(len(value.encode(self.encoding)))
 
 
 # class PaddedFixedFD(FixedLengthFD):
@@ -324,57 +510,369 @@ class StringFD(FieldDef):
 # TODO: Discriminated union FD?; ...
 
 
-class Packet(Serializable, metaclass=abc.ABCMeta):
+# Placeholder for values of lazily read packets, that are still only present in the raw data
+_NOT_DECODED = object()
+
+
+class _RecordingTransport(object):
+    """
+    Passes reads through to a transport, while keeping a copy of everything received
+    """
+
+    def __init__(self, tp, data):
+        """
+        :type tp: transport.Transport
+        :type data: bytearray
+        """
+        self.tp = tp
+        self.data = data
+
+    def read(self, amount):
+        value = self.tp.read(amount)
+        self.data += value
+        return value
+
+
+class PacketMeta(abc.ABCMeta):
+    """
+    Specializes packInto, read and readFrom for every packet class, based on its __structure__.
+
+    The generated methods are equivalent to the generic loops in Packet, but have each field unrolled, with the
+    corresponding FieldDef bound to a local name and the value addressed by its index.
+    Every field is also made accessible as a property of the same name, which decodes it first if needed
+    """
+
+    def __new__(mcs, name, bases, namespace, **kwargs):
+        cls = super().__new__(mcs, name, bases, namespace, **kwargs)
+        cls._fieldDefs = tuple(cls.__structure__)
+        cls._fieldsIndex = {fd.name: i for i, fd in enumerate(cls._fieldDefs)}
+        assert len(cls._fieldsIndex) == len(cls._fieldDefs), "Duplicate field names"
+        cls._defaultMissing = sum(1 for fd in cls._fieldDefs if fd.default is None)
+        mcs._computeSizes(cls)
+        mcs._computePrefixStruct(cls)
+        # Changes inside nested packets can't be noticed, so their raw data can't be trusted to stay up to date
+        cls._canReadLazy = not any(isinstance(fd, SerializableFD) for fd in cls._fieldDefs)
+        # Only specialize classes that define their own structure, even if it's empty; the rest just inherit the methods
+        if "__structure__" in namespace:
+            for methodName, method in mcs._compileMethods(cls).items():
+                if methodName not in namespace:
+                    setattr(cls, methodName, method)
+            for i, fd in enumerate(cls._fieldDefs):
+                if fd.name in namespace:
+                    continue
+                inherited = any(fd.name in getattr(base, "_fieldsIndex", ()) for base in cls.__mro__[1:])
+                if hasattr(cls, fd.name) and not inherited:
+                    raise TypeError(f"Field name {fd.name!r} clashes with an attribute of {name}")
+                setattr(cls, fd.name, mcs._makeProperty(i, i < cls._fixedPrefixLength))
+            # Fields of a parent structure that this one dropped must not stay reachable through inherited properties
+            for base in cls.__mro__[1:]:
+                for fieldName in getattr(base, "_fieldsIndex", ()):
+                    if fieldName not in cls._fieldsIndex and fieldName not in namespace:
+                        setattr(cls, fieldName, mcs._makeRemovedProperty(fieldName))
+        return cls
+
+    @staticmethod
+    def _makeRemovedProperty(fieldName):
+        def getter(self):
+            raise AttributeError(f"{type(self).__name__} has no field {fieldName!r}")
+
+        def setter(self, value):
+            getter(self)
+
+        return property(getter, setter)
+
+    @staticmethod
+    def _makeProperty(index, lazy):
+        def getter(self):
+            return self._values[index]
+
+        def lazyGetter(self):
+            value = self._values[index]
+            if value is _NOT_DECODED:
+                value = self._decodeLazy(index)
+            return value
+
+        def setter(self, value):
+            self._setValue(index, value)
+
+        return property(lazyGetter if lazy else getter, setter)
+
+    @staticmethod
+    def _computeSizes(cls):
+        # The leading fixed-size fields can all be received in one go, before anything else is parsed
+        offsets = []
+        prefixSize = 0
+        for fd in cls._fieldDefs:
+            if fd.size is None:
+                break
+            offsets.append(prefixSize)
+            prefixSize += fd.size
+        prefixLength = len(offsets)
+        cls._fixedOffsets = tuple(offsets)
+        cls._fixedPrefixLength = prefixLength
+        cls._fixedPrefixSize = prefixSize
+        cls._fixedSize = prefixSize if prefixLength == len(cls._fieldDefs) else None
+
+    @staticmethod
+    def _computePrefixStruct(cls):
+        # As many leading fields as possible are packed together with a single struct.Struct
+        order = None
+        fmt = ""
+        # For every field: its first item in the struct, and the number of items if the value is a tuple
+        items = []
+        start = 0
+        for fd in cls._fieldDefs[:cls._fixedPrefixLength]:
+            part = fd._structPart()
+            if part is None:
+                break
+            fdOrder, codes, count = part
+            if fdOrder is not None:
+                if order is not None and fdOrder != order:
+                    break
+                order = fdOrder
+            items.append((start, count))
+            start += 1 if count is None else count
+            fmt += codes
+        # A single field gains nothing from this
+        if len(items) < 2:
+            items = []
+        cls._prefixStruct = struct.Struct((order or ">") + fmt) if items else None
+        cls._prefixStructItems = tuple(items)
+
+    @staticmethod
+    def _compileMethods(cls):
+        """
+        :type cls: PacketMeta
+        :rtype: dict
+        """
+        structure = cls._fieldDefs
+        combined = len(cls._prefixStructItems)
+        # The generated functions get this as their globals, so the module is passed in to look DEBUG up at runtime
+        scope = {"_module": sys.modules[__name__]}
+        if cls._prefixStruct is not None:
+            scope["_prefixPack"] = cls._prefixStruct.pack
+            scope["_prefixUnpackFrom"] = cls._prefixStruct.unpack_from
+        for i, fd in enumerate(structure):
+            scope[f"_fd{i}"] = fd
+
+        def unpackPrefix(mv, offset):
+            lines = [f"    _t = _prefixUnpackFrom({mv}, {offset})"]
+            for i, (start, count) in enumerate(cls._prefixStructItems):
+                if count is None:
+                    lines.append(f"    _v[{i}] = _t[{start}]")
+                else:
+                    lines.append(f"    _v[{i}] = _t[{start}:{start + count}]")
+                if isinstance(structure[i], IntFD):
+                    lines.append(f"    if _fd{i}._check is not None and not _fd{i}._check(_v[{i}]):")
+                    lines.append(f"        raise _fd{i}._outOfRange(_v[{i}])")
+            lines.append("    if _module.DEBUG:")
+            lines += [f"        _fd{i}.validate(_v[{i}])" for i in range(combined)]
+            return lines
+
+        packSrc = ["def packInto(self, buf):",
+                   "    if self._raw is not None:",
+                   "        buf += self._raw",
+                   "        return",
+                   "    assert self.isComplete()",
+                   "    _v = self._values"]
+        # Values are collected separately and only replace the packet's own once everything is in. That way a failed
+        # read leaves the packet as it was, including the counter of missing fields and any lazily read data
+        readFromSrc = ["def readFrom(self, mv, offset):",
+                       f"    _v = [None] * {len(structure)}"]
+        if combined:
+            args = ", ".join(f"_v[{i}]" if count is None else f"*_v[{i}]"
+                             for i, (_, count) in enumerate(cls._prefixStructItems))
+            packSrc.append(f"    buf += _prefixPack({args})")
+            readFromSrc += unpackPrefix("mv", "offset")
+            readFromSrc.append(f"    offset += {cls._prefixStruct.size}")
+        for i in range(combined, len(structure)):
+            packSrc.append(f"    _fd{i}.packInto(_v[{i}], buf)")
+            readFromSrc.append(f"    _v[{i}], offset = _fd{i}.readFrom(mv, offset)")
+        readFromSrc += ["    self._values = _v",
+                        "    self._raw = None",
+                        "    self._missing = 0",
+                        "    return offset"]
+
+        readSrc = ["def read(self, tp):",
+                   f"    _v = [None] * {len(structure)}"]
+        if cls._fixedPrefixLength:
+            readSrc.append(f"    _buf = bytearray({cls._fixedPrefixSize})")
+            readSrc.append("    tp.readInto(_buf)")
+            readSrc.append("    _mv = memoryview(_buf)")
+            if combined:
+                readSrc += unpackPrefix("_mv", 0)
+            for i in range(combined, cls._fixedPrefixLength):
+                readSrc.append(f"    _v[{i}] = _fd{i}.readFrom(_mv, {cls._fixedOffsets[i]})[0]")
+        for i in range(cls._fixedPrefixLength, len(structure)):
+            readSrc.append(f"    _v[{i}] = _fd{i}.read(tp)")
+        readSrc += ["    self._values = _v",
+                    "    self._raw = None",
+                    "    self._missing = 0",
+                    "    return self"]
+
+        code = compile("\n".join(packSrc + readSrc + readFromSrc) + "\n", "<packet>", "exec")
+        exec(code, scope)
+        return {"packInto": scope["packInto"], "read": scope["read"], "readFrom": scope["readFrom"]}
+
+
+class Packet(Serializable, metaclass=PacketMeta):
+    __slots__ = ("_values", "_raw", "_missing")
     __structure__ = tuple()
 
     def __init__(self, **fieldValues):
-        self.__fields__ = collections.OrderedDict()
-        for fd in self.__structure__:
-            assert fd.name not in self.__fields__
-            self.__fields__[fd.name] = Field(fd)
+        self._values = [fd.default for fd in self._fieldDefs]
+        # The data this packet was received as, for as long as it's unchanged since. See readLazy
+        self._raw = None
+        # The number of fields that are None, so that isComplete doesn't have to look
+        self._missing = self._defaultMissing
         self.update(fieldValues)
 
     def write(self, tp):
+        self.writeMany((self,), tp)
+
+    @staticmethod
+    def writeMany(packets, tp):
+        """
+        Send several packets, possibly of different types, with a single call to the transport
+
+        :type packets: Iterable[Packet]
+        :type tp: transport.Transport
+        """
+        # Serialized straight into the transport's reusable buffer, to avoid allocating and copying one per send
+        buf = tp.sendBuffer
+        start = len(buf)
+        try:
+            for pkt in packets:
+                pkt.packInto(buf)
+        except BaseException:
+            # Nothing of a batch that failed to serialize should get sent
+            del buf[start:]
+            raise
+        tp.flush()
+
+    def packInto(self, buf):
+        if self._raw is not None:
+            buf += self._raw
+            return
         assert self.isComplete()
-        for field in self.__fields__.values():
-            field.write(tp)
+        for fd, value in zip(self._fieldDefs, self._values):
+            fd.packInto(value, buf)
 
     def read(self, tp):
-        for field in self.__fields__.values():
-            field.read(tp)
+        # Only applied once everything is in, so that a failed read leaves the packet as it was
+        values = [None] * len(self._fieldDefs)
+        prefixLength = self._fixedPrefixLength
+        if prefixLength:
+            buf = bytearray(self._fixedPrefixSize)
+            tp.readInto(buf)
+            mv = memoryview(buf)
+            offset = 0
+            for i in range(prefixLength):
+                values[i], offset = self._fieldDefs[i].readFrom(mv, offset)
+        for i in range(prefixLength, len(self._fieldDefs)):
+            values[i] = self._fieldDefs[i].read(tp)
+        self._values = values
+        self._raw = None
+        self._missing = 0
+        return self
+
+    def readFrom(self, mv, offset):
+        values = [None] * len(self._fieldDefs)
+        for i, fd in enumerate(self._fieldDefs):
+            values[i], offset = fd.readFrom(mv, offset)
+        self._values = values
+        self._raw = None
+        self._missing = 0
+        return offset
+
+    @classmethod
+    def readMany(cls, tp, count):
+        """
+        Receive several packets of this type in a row. Fixed-size packets are all received with a single read
+
+        :type tp: transport.Transport
+        :type count: int
+        :rtype: list[Packet]
+        """
+        if cls._fixedSize is None:
+            return [cls().read(tp) for _ in range(count)]
+        buf = bytearray(cls._fixedSize * count)
+        tp.readInto(buf)
+        mv = memoryview(buf)
+        packets = []
+        offset = 0
+        for _ in range(count):
+            pkt = cls()
+            offset = pkt.readFrom(mv, offset)
+            packets.append(pkt)
+        return packets
+
+    def readLazy(self, tp):
+        """
+        Like read, but the leading fixed-size fields are only decoded once accessed, and the received data is kept.
+        Until a field is changed, writing the packet just sends that same data again, which makes forwarding cheap.
+
+        Packets with nested Serializable fields are simply read as usual
+        """
+        if not self._canReadLazy:
+            return self.read(tp)
+        fds = self._fieldDefs
+        prefixLength = self._fixedPrefixLength
+        raw = bytearray(self._fixedPrefixSize)
+        tp.readInto(raw)
+        values = [_NOT_DECODED] * prefixLength
+        # Bounds are enforced on receive, like with read, so bounded integers can't be left for later
+        with memoryview(raw) as mv:
+            for i in range(prefixLength):
+                if isinstance(fds[i], IntFD) and fds[i]._check is not None:
+                    values[i], _ = fds[i].readFrom(mv, self._fixedOffsets[i])
+        recorder = _RecordingTransport(tp, raw)
+        for i in range(prefixLength, len(fds)):
+            values.append(fds[i].read(recorder))
+        # The packet is only touched once everything has been received
+        self._values = values
+        self._raw = bytes(raw)
+        self._missing = 0
+        return self
+
+    def _decodeLazy(self, index):
+        value, _ = self._fieldDefs[index].readFrom(memoryview(self._raw), self._fixedOffsets[index])
+        self._values[index] = value
+        return value
+
+    def _dropRaw(self):
+        # Whatever is still encoded has to be decoded before the raw data goes away
+        for i in range(self._fixedPrefixLength):
+            if self._values[i] is _NOT_DECODED:
+                self._decodeLazy(i)
+        self._raw = None
 
     def update(self, fieldsDict):
         for name, value in fieldsDict.items():
             self.setField(name, value)
 
     def isComplete(self):
-        for field in self.__fields__.values():
-            if field.value is None:
-                return False
-        return True
+        return self._missing == 0
 
     def hasField(self, name):
-        # Not hasattr because that calls getattr internally
-        return "__fields__" in dir(self) and name in self.__fields__
+        return name in self._fieldsIndex
 
-    def getField(self, name, asValue=True):
-        field = self.__fields__[name]
-        if not asValue:
-            return field
-        return field.value
+    def getField(self, name):
+        index = self._fieldsIndex[name]
+        value = self._values[index]
+        if value is _NOT_DECODED:
+            value = self._decodeLazy(index)
+        return value
 
     def setField(self, name, value):
-        self.__fields__[name].value = value
-
-    # This is only called for non-present attributes, so I only handle fields here
-    def __getattr__(self, name):
-        if self.hasField(name):
-            return self.getField(name)
-        raise AttributeError
-
-    def __setattr__(self, name, value):
-        if self.hasField(name):
-            self.setField(name, value)
-        else:
-            super().__setattr__(name, value)
-
+        self._setValue(self._fieldsIndex[name], value)
+
+    def _setValue(self, index, value):
+        # Values are only validated here, so that serialization doesn't have to
+        if value is not None:
+            self._fieldDefs[index].validate(value)
+        if self._raw is not None:
+            self._dropRaw()
+        values = self._values
+        self._missing += (value is None) - (values[index] is None)
+        values[index] = value
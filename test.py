@@ -2,6 +2,7 @@ import unittest
 import logging
 import transport
 import socket
+import struct
 import packet
 
 
@@ -44,6 +45,28 @@ class TransportTestCase(unittest.TestCase):
         result = self.t2.read(8)
         self.assertEqual(b''.join(data), result)
 
+    def test_buffered(self):
+        data = (b'1234', b'5678')
+        self.t1.writeBuffered(data[0])
+        self.t1.writeBuffered(data[1])
+        self.assertFalse(self.t2.hasData())
+        self.t1.flush()
+        self.assertEqual(b''.join(data), self.t2.read(8))
+        self.assertEqual(self.t1.sendBuffer, b'')
+
+    def test_bufferedOrder(self):
+        self.t1.writeBuffered(b'1234')
+        self.t1.write(b'5678')
+        self.assertEqual(b'12345678', self.t2.read(8))
+        self.assertEqual(self.t1.sendBuffer, b'')
+
+    def test_failedFlush(self):
+        # Far more than the socket buffers can hold, with nobody reading on the other side
+        self.t1.writeBuffered(bytes(1 << 24))
+        self.t1.setTimeout(0.05)
+        self.assertRaises(transport.Timeout, self.t1.flush)
+        self.assertEqual(self.t1.sendBuffer, b'')
+
     def test_readyCheck(self):
         data = b'test'
         self.assertFalse(self.t2.hasData())
@@ -54,6 +77,18 @@ class TransportTestCase(unittest.TestCase):
         self.t2.read(1)
         self.assertFalse(self.t2.hasData())
 
+    def test_readInto(self):
+        data = b'1234567'
+        self.t1.write(data)
+        buf = bytearray(len(data) + 2)
+        self.t2.readInto(memoryview(buf)[1:-1])
+        self.assertEqual(buf, b'\0' + data + b'\0')
+
+    def test_closed(self):
+        self.t1.write(b'123')
+        self.t1.close()
+        self.assertRaises(transport.NetworkError, self.t2.read, 4)
+
     def test_read0(self):
         self.assertEqual(self.t1.read(0), b'')
 
@@ -67,52 +102,66 @@ class FieldTestCase(unittest.TestCase):
         self.t1.close()
         self.t2.close()
 
-    def _test_FD(self, fd, data, badData):
-        field = packet.Field(fd)
-        field.value = data
-        field.write(self.t1)
-        field.value = badData
-        field.read(self.t2)
+    def _test_FD(self, fd, data):
+        fd.write(data, self.t1)
+        self._assertSameValue(data, fd.read(self.t2))
+
+        buf = bytearray(b'?')
+        fd.packInto(data, buf)
+        value, offset = fd.readFrom(memoryview(buf), 1)
+        self.assertEqual(offset, len(buf))
+        self._assertSameValue(data, value)
+
+    def _assertSameValue(self, data, value):
         if isinstance(data, float):
-            self.assertAlmostEqual(data, field.value)
+            self.assertAlmostEqual(data, value)
         else:
-            self.assertEqual(data, field.value)
+            self.assertEqual(data, value)
 
     def test_FixedLengthFD(self):
         data = b'Test data'
-        badData = b'Bad data!'
-        self.assertEqual(len(data), len(badData))
         fd = packet.FixedLengthFD("Test", len(data))
-        self._test_FD(fd, data, badData)
+        self._test_FD(fd, data)
 
     def test_VarLengthFD(self):
         data = b'Test data'
-        badData = b'Nope'
         fd = packet.VarLengthFD("Test", 1)
-        self._test_FD(fd, data, badData)
+        self._test_FD(fd, data)
 
     def test_IntFD(self):
         data = 123
-        badData = 456
         fd = packet.IntFD("Test", 2)
-        self._test_FD(fd, data, badData)
+        self._test_FD(fd, data)
         data = -123
-        badData = -456
         fd = packet.IntFD("Test", 2).setSigned(True)
-        self._test_FD(fd, data, badData)
+        self._test_FD(fd, data)
+        data = 0x123456
+        fd = packet.IntFD("Test", 3).setOrder("little")
+        self._test_FD(fd, data)
+
+    def test_defaultIntFD(self):
+        data = 0x1234
+        fd = packet.IntFD("Test", 2).setDefault(data).setOrder("little")
+        buf = bytearray()
+        fd.packInto(data, buf)
+        self.assertEqual(buf, b'\x34\x12')
+        self._test_FD(fd, data)
 
     def test_FloatFD(self):
         data = 1.23
-        badData = 4.56
         fd = packet.FloatFD("Test")
-        self._test_FD(fd, data, badData)
+        self._test_FD(fd, data)
 
     def test_StructFD(self):
         format = ">?i3s"
         data = (True, 1, b"Hi!")
-        badData = (False, 7, b"Bye")
         fd = packet.StructFD("Test", format)
-        self._test_FD(fd, data, badData)
+        self._test_FD(fd, data)
+
+    def test_StringFD(self):
+        data = "Test строка"
+        fd = packet.StringFD("Test", 2)
+        self._test_FD(fd, data)
 
     # TODO: Other FDs
 
@@ -121,6 +170,18 @@ class TestPacket(packet.Packet):
     __structure__ = (packet.IntFD("TPID", 1).setDefault(17), packet.StringFD("TPVAL", 1).setMaxLength(32))
 
 
+class FixedPacket(packet.Packet):
+    __structure__ = (packet.IntFD("FPID", 2), packet.FloatFD("FPVAL"), packet.StructFD("FPSTRUCT", ">?i3s"))
+
+
+class BoundedPacket(packet.Packet):
+    __structure__ = (packet.IntFD("BPID", 1).setMax(10), packet.IntFD("BPVAL", 1))
+
+
+class NestingPacket(packet.Packet):
+    __structure__ = (packet.SerializableFD("NPINNER", TestPacket), packet.FloatFD("NPVAL"))
+
+
 class PacketTestCase(unittest.TestCase):
     def setUp(self):
         defaultTO = 0.5
@@ -138,11 +199,56 @@ class PacketTestCase(unittest.TestCase):
         self.assertEqual(sp.TPID, rp.TPID)
         self.assertEqual(sp.TPVAL, rp.TPVAL)
 
+    def test_writeMany(self):
+        sps = [TestPacket(TPID=i, TPVAL=str(i)) for i in range(3)]
+        packet.Packet.writeMany(sps + [FixedPacket(FPID=5, FPVAL=1.5, FPSTRUCT=(True, -3, b"abc"))], self.t1)
+        for sp in sps:
+            rp = TestPacket().read(self.t2)
+            self.assertEqual(sp.TPID, rp.TPID)
+            self.assertEqual(sp.TPVAL, rp.TPVAL)
+        self.assertEqual(FixedPacket().read(self.t2).FPID, 5)
+
+    def test_readMany(self):
+        sps = [FixedPacket(FPID=i, FPVAL=0.5, FPSTRUCT=(False, i, b"xyz")) for i in range(3)]
+        packet.Packet.writeMany(sps + [TestPacket(TPVAL="A"), TestPacket(TPVAL="B")], self.t1)
+        rps = FixedPacket.readMany(self.t2, 3)
+        self.assertEqual([rp.FPSTRUCT for rp in rps], [sp.FPSTRUCT for sp in sps])
+        rps = TestPacket.readMany(self.t2, 2)
+        self.assertEqual([rp.TPVAL for rp in rps], ["A", "B"])
+
+    def test_failedWrite(self):
+        # Defaults aren't validated, so this one only fails once it's packed
+        class OversizedPacket(packet.Packet):
+            __structure__ = (packet.StringFD("OPVAL", 1).setDefault("x" * 300),)
+
+        self.assertRaises(struct.error, packet.Packet.writeMany, [TestPacket(TPVAL="A"), OversizedPacket()], self.t1)
+        self.assertEqual(self.t1.sendBuffer, b'')
+        self.assertFalse(self.t2.hasData())
+
     def test_isComplete(self):
         p = TestPacket(TPVAL="Hello there")
         self.assertTrue(p.isComplete())
         p = TestPacket()
         self.assertFalse(p.isComplete())
+        p.TPVAL = "Hello there"
+        self.assertTrue(p.isComplete())
+        p.setField("TPID", None)
+        self.assertFalse(p.isComplete())
+        TestPacket(TPVAL="Received").write(self.t1)
+        p.read(self.t2)
+        self.assertTrue(p.isComplete())
+
+    def test_interruptedRead(self):
+        class NoDefaultPacket(packet.Packet):
+            __structure__ = (packet.IntFD("NDID", 1), packet.StringFD("NDVAL", 1))
+
+        self.t1.write(b'\x05')
+        p = NoDefaultPacket()
+        self.assertRaises(transport.Timeout, p.read, self.t2)
+        self.assertFalse(p.isComplete())
+        p.NDVAL = "hi"
+        p.NDID = 4
+        self.assertTrue(p.isComplete())
 
     def test_update(self):
         data = "Something"
@@ -156,6 +262,110 @@ class PacketTestCase(unittest.TestCase):
         self.assertTrue(p.hasField("TPID"))
         self.assertFalse(p.hasField("Non-existent field"))
 
+    def test_nameClash(self):
+        for name in ("update", "read", "write", "_values"):
+            with self.assertRaises(TypeError):
+                type("ClashingPacket", (packet.Packet,), {"__structure__": (packet.IntFD(name, 1),)})
+
+        class Extended(TestPacket):
+            __structure__ = TestPacket.__structure__ + (packet.IntFD("EXTRA", 1),)
+
+        p = Extended(TPVAL="Inherited", EXTRA=1)
+        self.assertEqual(p.TPVAL, "Inherited")
+
+    def test_emptySubclass(self):
+        class Emptied(TestPacket):
+            __structure__ = ()
+
+        p = Emptied()
+        p.write(self.t1)
+        self.assertFalse(self.t2.hasData())
+        self.assertIs(p.read(self.t2), p)
+        self.assertFalse(p.hasField("TPID"))
+        self.assertFalse(hasattr(p, "TPID"))
+        with self.assertRaises(AttributeError):
+            p.TPID = 1
+
+    def test_attributes(self):
+        p = TestPacket()
+        p.TPVAL = "Something"
+        self.assertEqual(p.getField("TPVAL"), "Something")
+        with self.assertRaises(ValueError):
+            p.TPID = "Not an int"
+        self.assertRaises(AttributeError, getattr, p, "NONEXISTENT")
+
+    def test_fixedExchange(self):
+        self.assertEqual(FixedPacket._fixedSize, 14)
+        self.assertIsNone(TestPacket._fixedSize)
+        self.assertEqual(TestPacket._fixedPrefixSize, 1)
+        self.assertEqual(FixedPacket._prefixStruct.format, ">Hf?i3s")
+
+        class LittleEndianPacket(packet.Packet):
+            __structure__ = (packet.IntFD("LPTYPE", 1),
+                             packet.IntFD("LPA", 2).setOrder("little"), packet.IntFD("LPB", 2).setOrder("little"))
+
+        self.assertEqual(LittleEndianPacket._prefixStruct.format, "<BHH")
+        LittleEndianPacket(LPTYPE=1, LPA=2, LPB=3).write(self.t1)
+        self.assertEqual(self.t2.read(5), b'\x01\x02\x00\x03\x00')
+        sp = FixedPacket(FPID=5, FPVAL=1.5, FPSTRUCT=(True, -3, b"abc"))
+        sp.write(self.t1)
+        rp = FixedPacket().read(self.t2)
+        self.assertEqual(rp.FPID, 5)
+        self.assertEqual(rp.FPVAL, 1.5)
+        self.assertEqual(rp.FPSTRUCT, (True, -3, b"abc"))
+
+    def test_validation(self):
+        p = TestPacket()
+        self.assertRaises(ValueError, p.setField, "TPID", "Not an int")
+        self.assertRaises(ValueError, p.setField, "TPVAL", "Too long" * 5)
+        self.assertEqual(p.TPID, 17)
+        self.assertIsNone(p.TPVAL)
+
+    def test_outOfRange(self):
+        self.t1.write(b'\x21' + b'!' * 33)
+        self.assertRaises(ValueError, TestPacket().read, self.t2)
+
+    def test_lazyExchange(self):
+        sp = TestPacket(TPID=3, TPVAL="Forwarded")
+        sp.write(self.t1)
+        rp = TestPacket().readLazy(self.t2)
+        rp.write(self.t1)
+        self.assertEqual(rp.TPVAL, "Forwarded")
+        self.assertEqual(rp.getField("TPID"), 3)
+
+        rp = TestPacket().readLazy(self.t2)
+        rp.TPVAL = "Changed"
+        self.assertEqual(rp.TPID, 3)
+        rp.write(self.t1)
+        rp = TestPacket().read(self.t2)
+        self.assertEqual(rp.TPID, 3)
+        self.assertEqual(rp.TPVAL, "Changed")
+
+    def test_lazyThenFailedRead(self):
+        TestPacket(TPID=3, TPVAL="Lazy").write(self.t1)
+        p = TestPacket().readLazy(self.t2)
+        self.assertRaises(transport.Timeout, p.read, self.t2)
+        self.assertIsInstance(p.TPID, int)
+        self.assertEqual(p.TPVAL, "Lazy")
+        p.write(self.t1)
+        rp = TestPacket().read(self.t2)
+        self.assertEqual((rp.TPID, rp.TPVAL), (p.TPID, p.TPVAL))
+
+    def test_lazyOutOfRange(self):
+        self.t1.write(b'\x63\x01')
+        p = BoundedPacket()
+        self.assertRaises(ValueError, p.readLazy, self.t2)
+        self.assertFalse(p.isComplete())
+        self.assertIsNone(p.BPVAL)
+
+    def test_nested(self):
+        sp = NestingPacket(NPINNER=TestPacket(TPVAL="Inner"), NPVAL=0.5)
+        sp.write(self.t1)
+        rp = NestingPacket().read(self.t2)
+        self.assertEqual(rp.NPINNER.TPID, 17)
+        self.assertEqual(rp.NPINNER.TPVAL, "Inner")
+        self.assertEqual(rp.NPVAL, 0.5)
+
     # TODO: Probably more tests, but I'm lazy
 
 
@@ -2,7 +2,7 @@ import logging
 from typing import *
 import abc
 import socket
-import selectors
+import select
 import time
 
 
@@ -29,8 +29,8 @@ class Transport(object):
         self.socket = sock
         self.defaultTimeout = defaultTimeout
         self.socket.settimeout(self.defaultTimeout)
-        self.selector = selectors.DefaultSelector()
-        self.selector.register(self.socket, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        # Outgoing data waiting for flush(). It's reused between sends, and can be serialized into directly
+        self.sendBuffer = bytearray()
 
     def __enter__(self):
         return self
@@ -46,8 +46,14 @@ class Transport(object):
 
     def write(self, data):
         """
+        Send data right away. Anything still queued in sendBuffer goes out first, so the order is always kept
+
         :type data: bytes
         """
+        if self.sendBuffer:
+            self.sendBuffer += data
+            self.flush()
+            return
         try:
             self.socket.sendall(data)
         except socket.timeout:
@@ -56,39 +62,83 @@ class Transport(object):
             logging.error("[ERROR] Transport.write {}", e)
             raise NetworkError("Transport.write", e)
 
+    def writeBuffered(self, data):
+        """
+        Queue data to be sent by the next flush() call
+
+        :type data: bytes
+        """
+        self.sendBuffer += data
+
+    def flush(self):
+        """
+        Send everything in sendBuffer. On error the unsent rest is dropped as well: the peer has already got part of
+        it, so the stream is broken either way, and resending the rest later would only put garbage after other data
+        """
+        buf = self.sendBuffer
+        sent = 0
+        try:
+            with memoryview(buf) as mv:
+                while sent < len(mv):
+                    sent += self.socket.send(mv[sent:])
+        except socket.timeout:
+            raise Timeout("Transport.flush")
+        except socket.error as e:
+            logging.error("[ERROR] Transport.flush %s", e)
+            raise NetworkError("Transport.flush", e)
+        finally:
+            buf.clear()
+
     def read(self, amount):
         """
         :type amount: int
         :rtype: bytes
         """
+        buf = bytearray(amount)
+        self.readInto(buf)
+        return bytes(buf)
+
+    def readInto(self, buf):
+        """
+        Fill the whole of buf with received data
+
+        :type buf: bytearray | memoryview
+        """
+        oldTimeout = self.socket.gettimeout()
+        deadline = None if oldTimeout is None else time.monotonic() + oldTimeout
+        timeoutChanged = False
         try:
-            # MSG_WAITALL doesn't work on Windows, so now I have to do horrible things like this
-            data = bytearray()
-            oldTimeout = self.socket.gettimeout()
-            deadline = time.monotonic() + oldTimeout
-            while len(data) < amount:
-                try:
-                    data += self.socket.recv(amount)
-                except socket.timeout:
-                    pass
-                interval = deadline - time.monotonic()
-                self.socket.settimeout(interval)
-                if interval <= 0:
-                    self.socket.settimeout(oldTimeout)
-                    raise Timeout("Transport.read")
-            self.socket.settimeout(oldTimeout)
-            return bytes(data)
+            with memoryview(buf) as mv:
+                amount = mv.nbytes
+                received = 0
+                while received < amount:
+                    chunk = self.socket.recv_into(mv[received:])
+                    if chunk == 0:
+                        raise NetworkError("Transport.read", "Connection closed")
+                    received += chunk
+                    if received < amount and deadline is not None:
+                        # MSG_WAITALL doesn't work on Windows, so the overall timeout has to be enforced by hand
+                        interval = deadline - time.monotonic()
+                        if interval <= 0:
+                            raise Timeout("Transport.read")
+                        self.socket.settimeout(interval)
+                        timeoutChanged = True
+        except socket.timeout:
+            raise Timeout("Transport.read")
         except socket.error as e:
             logging.error("[ERROR] Transport.read {}", e)
             raise NetworkError("Transport.read", e)
+        finally:
+            if timeoutChanged:
+                self.socket.settimeout(oldTimeout)
 
     def close(self):
         self.socket.close()
-        self.selector.close()
 
     def _isReady(self):
-        _, events = self.selector.select(timeout=self.socket.gettimeout())[0]
-        return events & selectors.EVENT_READ, events & selectors.EVENT_WRITE
+        # A zero timeout makes this a poll, so it never blocks
+        readable, writable, _ = select.select([self.socket], [self.socket], [], 0)
+        return bool(readable), bool(writable)
 
     def hasData(self):
         return self._isReady()[0]